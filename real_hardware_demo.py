@@ -3,26 +3,201 @@
 REAL ChipWhisperer Demo - Captures actual hardware data
 """
 
-import chipwhisperer as cw
 import numpy as np
-import matplotlib.pyplot as plt
 import time
 import random
+from functools import lru_cache
+
+try:
+    from numba import njit, prange
+except ImportError:
+    njit = None
+
+
+def _normalized_sum(traces, xp=np):
+    """Sum of the traces after centring each one and scaling it to unit norm"""
+    x = traces.astype(xp.float32)
+    x -= x.mean(axis=1, keepdims=True)
+    x /= xp.linalg.norm(x, axis=1, keepdims=True)
+    return x.sum(axis=0, dtype=xp.float64)
+
+
+def _merge_moments(count, mean, m2, n, tile_mean, tile_m2):
+    """Fold a tile's per-sample mean/M2 over n traces into the running ones"""
+    total = count + n
+    delta = tile_mean - mean
+    mean += delta * (n / total)
+    m2 += tile_m2 + delta * delta * (count * n / total)
+
+
+def _accumulate_numpy(traces, count, mean, m2, z_sum):
+    """Fold traces into the running per-sample mean/M2 and normalised sum"""
+    # One widened copy of the tile serves both the per-trace and the
+    # per-sample statistics
+    x = traces.astype(np.float32)
+    n, m = x.shape
+    # Normalised sum first: sum_i (x_i - mu_i) * scale_i as two GEMVs
+    row_mean = x.mean(axis=1, dtype=np.float64)
+    ss = np.einsum('ij,ij->i', x, x, dtype=np.float64) - m * row_mean ** 2
+    # Constant traces get a NaN scale, as in the Numba kernel
+    scale = np.full(n, np.nan)
+    keep = ss > 1e-20 * m * row_mean ** 2
+    scale[keep] = 1.0 / np.sqrt(ss[keep])
+    z_sum += scale.astype(np.float32) @ x - scale @ row_mean
+    # Then centre in place for the tile's per-sample moments
+    tile_mean = x.mean(axis=0, dtype=np.float64)
+    x -= tile_mean.astype(np.float32)
+    tile_m2 = np.einsum('ij,ij->j', x, x, dtype=np.float64)
+    _merge_moments(count, mean, m2, n, tile_mean, tile_m2)
+
+
+# Samples per thread block in the Numba column pass; keeps the running
+# per-sample state of a block resident in L1
+SAMPLE_BLOCK = 256
+
+
+if njit is not None:
+    # No 'nnan'/'ninf' fast-math flags: constant traces carry a NaN scale
+    # that has to propagate into z_sum, which full fastmath makes undefined
+    @njit(parallel=True, fastmath={'reassoc', 'contract', 'arcp'}, cache=True)
+    def _accumulate(traces, count, mean, m2, z_sum):
+        """Fold traces into the running per-sample mean/M2 and normalised sum"""
+        n, m = traces.shape
+        # Centring offset and unit-norm scale of each trace, rows in parallel
+        mu = np.empty(n)
+        scale = np.empty(n)
+        for i in prange(n):
+            a = 0.0
+            for j in range(m):
+                a += float(traces[i, j])
+            mu_i = a / m
+            # Sum of squares from centred values: reassociation may reorder a
+            # b - a*a/m form so a constant trace comes out slightly positive
+            ss = 0.0
+            for j in range(m):
+                d = float(traces[i, j]) - mu_i
+                ss += d * d
+            mu[i] = mu_i
+            # Constant traces have no defined correlation (NaN, as in
+            # np.corrcoef); the tolerance absorbs rounding in mu_i
+            scale[i] = 1.0 / np.sqrt(ss) if ss > 1e-20 * m * mu_i * mu_i else np.nan
+        # Welford update continued from the previous tiles, together with
+        # the normalised sum. Threads own contiguous blocks of samples and
+        # sweep each trace row across their block, so the inner loop is
+        # unit-stride over the row-major traces
+        for blk in prange((m + SAMPLE_BLOCK - 1) // SAMPLE_BLOCK):
+            j0 = blk * SAMPLE_BLOCK
+            j1 = min(j0 + SAMPLE_BLOCK, m)
+            for i in range(n):
+                w = 1.0 / (count + i + 1)
+                mu_i = mu[i]
+                scale_i = scale[i]
+                for j in range(j0, j1):
+                    v = float(traces[i, j])
+                    d = v - mean[j]
+                    mean[j] += d * w
+                    m2[j] += d * (v - mean[j])
+                    z_sum[j] += (v - mu_i) * scale_i
+else:
+    _accumulate = _accumulate_numpy
+
+
+def _avg_correlation(z_sum, n):
+    """Average pairwise correlation of n traces from their _normalized_sum"""
+    if n < 2:
+        return 0
+    # For unit-norm rows z_i, |sum(z_i)|^2 = n + 2 * sum_{i<j} corr(i, j),
+    # so the mean over the n(n-1)/2 pairs needs no (n, n) matrix
+    return float((z_sum @ z_sum - n) / (n * (n - 1)))
+
+
+def _truncate_npy(path, rows):
+    """Shrink the .npy array at path to its first `rows` rows, in place"""
+    fmt = np.lib.format
+    with open(path, 'r+b') as f:
+        version = fmt.read_magic(f)
+        if version == (1, 0):
+            shape, fortran_order, dtype = fmt.read_array_header_1_0(f)
+            header_start = 10  # magic string, version, 2-byte length
+        else:
+            shape, fortran_order, dtype = fmt.read_array_header_2_0(f)
+            header_start = 12  # magic string, version, 4-byte length
+        data_start = f.tell()
+        header = repr({'descr': fmt.dtype_to_descr(dtype),
+                       'fortran_order': fortran_order,
+                       'shape': (rows,) + shape[1:]})
+        # Pad to the old header length so the data offset doesn't move
+        header = header.ljust(data_start - header_start - 1) + '\n'
+        f.seek(header_start)
+        f.write(header.encode('latin1'))
+        f.truncate(data_start + rows * int(np.prod(shape[1:])) * dtype.itemsize)
+
+
+# Traces per tile in analyze_traces; bounds the float32 working set
+ANALYSIS_CHUNK = 4096
+
+
+# Upper bound on points drawn per line in generate_plot
+PLOT_POINTS = 2000
+
+
+@lru_cache(maxsize=8)
+def _plot_x(n, step=1, repeat=1):
+    """Shared read-only x positions for plotted lines over n samples"""
+    x = np.repeat(np.arange(0, n, step), repeat)
+    x.flags.writeable = False
+    return x
+
+
+def _decimate(y, target=PLOT_POINTS):
+    """Min/max envelope of y with about `target` points, plus matching x"""
+    step = max(1, 2 * len(y) // target)
+    if step == 1:
+        return _plot_x(len(y)), y
+    # Each bin of `step` samples becomes its min and max (trailing
+    # partial bin is dropped)
+    n = len(y) // step * step
+    bins = y[:n].reshape(-1, step)
+    x = _plot_x(n, step, 2)
+    envelope = np.empty(x.size, dtype=y.dtype)
+    envelope[0::2] = bins.min(axis=1)
+    envelope[1::2] = bins.max(axis=1)
+    return x, envelope
+
+
+def _decimate_band(lo, hi, target=PLOT_POINTS):
+    """Outer envelope of the band lo..hi with about `target` points, plus matching x"""
+    step = max(1, len(lo) // target)
+    if step == 1:
+        return _plot_x(len(lo)), lo, hi
+    n = len(lo) // step * step
+    return (_plot_x(n, step),
+            lo[:n].reshape(-1, step).min(axis=1),
+            hi[:n].reshape(-1, step).max(axis=1))
+
 
 class RealChipWhispererDemo:
-    def __init__(self):
+    def __init__(self, verbose=True):
+        self.verbose = verbose
+        self._cw = None
         self.scope = None
         self.target = None
         self.connected = False
-        self.traces = []
+        self.nsamples = 0
+        self.traces = None
+        self.n_captured = 0
         
     def connect(self):
         """Connect to real ChipWhisperer hardware"""
         try:
             print("🔌 Connecting to ChipWhisperer hardware...")
+            # Imported here so startup doesn't pay for it before it's needed
+            import chipwhisperer as cw
+            self._cw = cw
             self.scope = cw.scope()
             self.target = cw.target(self.scope, cw.targets.SimpleSerial)
             self.scope.default_setup()
+            self.nsamples = self.scope.adc.samples
             self.connected = True
             print("✅ Connected to real ChipWhisperer hardware!")
             return True
@@ -38,7 +213,18 @@ class RealChipWhispererDemo:
             
             # Test 'p' command
             self.target.simpleserial_write('p', bytearray([0xAA] * 16))
-            time.sleep(0.2)
+            # Poll until the whole reply (incl. ack) has arrived, i.e. the
+            # buffered byte count has stopped growing for 20 ms, instead of
+            # always sleeping 200 ms
+            deadline = time.time() + 0.2
+            waiting, last_change = 0, time.time()
+            while time.time() < deadline:
+                time.sleep(0.002)
+                now = self.target.in_waiting()
+                if now != waiting:
+                    waiting, last_change = now, time.time()
+                elif waiting and time.time() - last_change >= 0.02:
+                    break
             response = self.target.read()
             print(f"   Target response: {len(response)} bytes")
             if response:
@@ -52,97 +238,145 @@ class RealChipWhispererDemo:
             return False
     
     def capture_real_trace(self, input_data):
-        """Capture a single real power trace"""
+        """Capture a single real power trace for a bytes-like input"""
         try:
-            # Arm the scope
-            self.scope.arm()
-            
-            # Send command to target
-            self.target.simpleserial_write('p', bytearray(input_data))
-            
-            # Capture the trace
-            self.scope.capture()
-            
-            # Get the trace data
-            trace = self.scope.get_last_trace()
+            # Arm, send the command, capture and read back the response in
+            # ChipWhisperer's own capture loop (None on capture timeout)
+            result = self._cw.capture_trace(self.scope, self.target, input_data, as_int=True)
             
-            return trace
+            return result.wave if result is not None else None
         except Exception as e:
             print(f"   ❌ Trace capture failed: {e}")
             return None
     
-    def capture_multiple_traces(self, num_traces=5):
-        """Capture multiple real power traces with different inputs"""
+    def capture_multiple_traces(self, num_traces=5, store_path=None):
+        """Capture multiple real power traces with different inputs
+        
+        With store_path, traces are written straight to a .npy memmap there
+        instead of being held in RAM. Afterwards the file is shrunk to the
+        n_captured traces actually stored, so np.load(store_path) returns
+        only real traces (failed or rejected captures leave no rows).
+        """
         print(f"🔬 Capturing {num_traces} REAL power traces...")
         
-        self.traces = []
+        # Preallocate one contiguous row per trace; raw ADC codes fit in
+        # int16 and are only widened to float inside the reductions
+        shape = (num_traces, self.nsamples)
+        if store_path:
+            self.traces = np.lib.format.open_memmap(store_path, mode='w+',
+                                                    dtype=np.int16, shape=shape)
+        else:
+            self.traces = np.empty(shape, dtype=np.int16)
+        self.n_captured = 0
+        
+        # Drop anything left over (e.g. from the communication test) so
+        # each capture's response lines up with its own input
+        self.target.flush()
+        
+        # Use different input data for each trace: row i is 16 bytes of i % 256
+        inputs = np.repeat((np.arange(num_traces) & 0xFF).astype(np.uint8)[:, None], 16, axis=1)
         
         for i in range(num_traces):
-            print(f"  📊 Trace {i+1}/{num_traces}...")
-            
-            # Use different input data for each trace
-            input_data = [i % 256] * 16
+            # Only report every 100th trace so logging stays off the hot path
+            report = self.verbose and i % 100 == 0
+            if report:
+                print(f"  📊 Trace {i+1}/{num_traces}...")
             
             # Capture real trace
-            trace = self.capture_real_trace(input_data)
+            trace = self.capture_real_trace(inputs[i].tobytes())
             
-            if trace is not None:
-                self.traces.append(trace)
-                print(f"    ✅ Captured {len(trace)} samples")
-                
-                # Show some trace statistics
-                print(f"    📈 Range: {np.min(trace):.3f} to {np.max(trace):.3f}")
-                print(f"    📊 Mean: {np.mean(trace):.3f}, Std: {np.std(trace):.3f}")
+            if trace is not None and trace.shape != (self.nsamples,):
+                # Never store a short/long capture into the fixed-width buffer
+                print(f"    ❌ Trace {i+1} has {len(trace)} samples, expected {self.nsamples}")
+            elif trace is not None:
+                self.traces[self.n_captured] = trace
+                self.n_captured += 1
+                if report:
+                    print(f"    ✅ Captured {len(trace)} samples")
+                    
+                    # Show the trace range; mean/std come from analyze_traces
+                    print(f"    📈 Range: {trace.min()} to {trace.max()}")
             else:
                 print(f"    ❌ Failed to capture trace {i+1}")
         
-        print(f"✅ Captured {len(self.traces)} real traces")
-        return len(self.traces) > 0
+        if store_path:
+            self.traces.flush()
+            if self.n_captured < num_traces:
+                # Unmap before truncating, then map the shrunk file again
+                self.traces = None
+                _truncate_npy(store_path, self.n_captured)
+                self.traces = np.load(store_path, mmap_mode='r+')
+        print(f"✅ Captured {self.n_captured} real traces")
+        return self.n_captured > 0
     
-    def analyze_traces(self):
-        """Analyze the real captured traces"""
-        if not self.traces:
+    def analyze_traces(self, use_gpu=False):
+        """Analyze the real captured traces (optionally on the GPU via CuPy)"""
+        if not self.n_captured:
             print("❌ No traces to analyze!")
             return False
         
         print("🧮 Analyzing REAL power traces...")
         
-        # Convert to numpy array
-        trace_array = np.array(self.traces)
+        xp = np
+        if use_gpu:
+            try:
+                import cupy as xp
+            except ImportError:
+                print("⚠ CuPy not available, analyzing on the CPU")
+                use_gpu = False
+        
+        # Stream the traces through in tiles, updating the running
+        # per-sample mean/M2 (Welford) and the normalised-trace sum (on
+        # the GPU if requested)
+        n = self.n_captured
+        mean = xp.zeros(self.traces.shape[1])
+        m2 = xp.zeros_like(mean)
+        z_sum = xp.zeros_like(mean)
+        for lo in range(0, n, ANALYSIS_CHUNK):
+            block = self.traces[lo:min(lo + ANALYSIS_CHUNK, n)]
+            if use_gpu:
+                # Upload int16 and widen one float32 copy at a time: the
+                # normalised sum makes its own, then the moments reuse one
+                # centred and squared in place
+                raw = xp.asarray(block)
+                z_sum += _normalized_sum(raw, xp)
+                x = raw.astype(xp.float32)
+                tile_mean = x.mean(axis=0, dtype=xp.float64)
+                x -= tile_mean.astype(xp.float32)
+                xp.square(x, out=x)
+                _merge_moments(lo, mean, m2, x.shape[0], tile_mean,
+                               x.sum(axis=0, dtype=xp.float64))
+                del x
+            else:
+                # Plain ndarray view of the tile (memmap pages load here);
+                # Numba kernel when available, else NumPy reductions
+                _accumulate(np.asarray(block), lo, mean, m2, z_sum)
+        if use_gpu:
+            mean, m2, z_sum = xp.asnumpy(mean), xp.asnumpy(m2), xp.asnumpy(z_sum)
         
         # Calculate statistics
-        mean_trace = np.mean(trace_array, axis=0)
-        std_trace = np.std(trace_array, axis=0)
+        mean_trace = mean.astype(np.float32)
+        variance = (m2 / n).astype(np.float32)
+        avg_correlation = _avg_correlation(z_sum, n)
+        std_trace = np.sqrt(variance)
         max_power = np.max(mean_trace)
         min_power = np.min(mean_trace)
         
         # Find interesting points (high variance)
-        variance = np.var(trace_array, axis=0)
-        mean_variance = np.mean(variance)
-        interesting_points = np.where(variance > mean_variance * 1.5)[0]
-        
-        # Calculate correlation between traces
-        if len(self.traces) > 1:
-            correlations = []
-            for i in range(len(self.traces)):
-                for j in range(i+1, len(self.traces)):
-                    corr = np.corrcoef(self.traces[i], self.traces[j])[0,1]
-                    correlations.append(corr)
-            avg_correlation = np.mean(correlations) if correlations else 0
-        else:
-            avg_correlation = 0
+        interesting_mask = variance > 1.5 * variance.mean()
         
         analysis = {
-            'num_traces': len(self.traces),
+            'num_traces': self.n_captured,
             'trace_length': len(mean_trace),
             'max_power': max_power,
             'min_power': min_power,
-            'power_range': max_power - min_power,
-            'interesting_points': len(interesting_points),
+            'power_range': np.ptp(mean_trace),
+            'interesting_points': int(interesting_mask.sum()),
             'avg_correlation': avg_correlation,
             'mean_trace': mean_trace,
             'std_trace': std_trace,
-            'variance': variance
+            'variance': variance,
+            'interesting_mask': interesting_mask
         }
         
         print("✅ REAL data analysis complete!")
@@ -154,22 +388,28 @@ class RealChipWhispererDemo:
         
         return analysis
     
-    def generate_plot(self, save_path="real_chipwhisperer_demo.png"):
-        """Generate plot of real hardware data"""
-        if not self.traces:
+    def generate_plot(self, analysis, save_path="real_chipwhisperer_demo.png"):
+        """Generate plot of real hardware data from analyze_traces() results"""
+        if not self.n_captured:
             print("❌ No traces to plot!")
             return False
         
         print("📊 Generating visualization of REAL hardware data...")
         
+        # Only the Agg backend is needed to write the file; importing it
+        # lazily also skips the GUI backend probe at startup
+        import matplotlib
+        matplotlib.use('Agg')
+        import matplotlib.pyplot as plt
+        
         # Create figure
         fig, (ax1, ax2) = plt.subplots(2, 1, figsize=(14, 10))
         
         # Plot individual traces
         colors = ['#1f77b4', '#ff7f0e', '#2ca02c', '#d62728', '#9467bd']
-        for i, trace in enumerate(self.traces[:5]):
-            ax1.plot(trace, alpha=0.8, color=colors[i % len(colors)], 
-                    linewidth=1.2, label=f'Real Trace {i+1}')
+        for i, trace in enumerate(self.traces[:min(self.n_captured, 5)]):
+            ax1.plot(*_decimate(trace), alpha=0.8, color=colors[i % len(colors)], 
+                    linewidth=1.2, label=f'Real Trace {i+1}', rasterized=True)
         
         ax1.set_title('REAL ChipWhisperer Power Traces - Live Hardware Data', 
                      fontsize=16, fontweight='bold', pad=20)
@@ -180,24 +420,26 @@ class RealChipWhispererDemo:
         ax1.set_facecolor('#f8f9fa')
         
         # Plot statistical analysis
-        if len(self.traces) > 1:
-            trace_array = np.array(self.traces)
-            mean_trace = np.mean(trace_array, axis=0)
-            std_trace = np.std(trace_array, axis=0)
+        if self.n_captured > 1:
+            mean_trace = analysis['mean_trace']
+            std_trace = analysis['std_trace']
             
-            ax2.plot(mean_trace, color='#2c3e50', linewidth=2.5, label='Mean Power')
-            ax2.fill_between(range(len(mean_trace)), 
-                           mean_trace - std_trace, 
-                           mean_trace + std_trace, 
-                           alpha=0.3, color='#3498db', label='±1σ Standard Deviation')
+            # Draw decimated envelopes; matplotlib cost scales with points
+            ax2.plot(*_decimate(mean_trace), color='#2c3e50', linewidth=2.5, label='Mean Power',
+                     rasterized=True)
+            lo = np.subtract(mean_trace, std_trace)
+            hi = np.add(mean_trace, std_trace)
+            ax2.fill_between(*_decimate_band(lo, hi), 
+                           alpha=0.3, color='#3498db', label='±1σ Standard Deviation',
+                           rasterized=True)
             
             # Highlight interesting points
-            variance = np.var(trace_array, axis=0)
-            mean_variance = np.mean(variance)
-            interesting_points = np.where(variance > mean_variance * 1.5)[0]
-            if len(interesting_points) > 0:
-                ax2.scatter(interesting_points, mean_trace[interesting_points], 
-                          color='red', s=20, alpha=0.8, label='High Variance Points')
+            interesting_mask = analysis['interesting_mask']
+            interesting_points = np.flatnonzero(interesting_mask)
+            if interesting_points.size:
+                ax2.scatter(interesting_points, mean_trace[interesting_mask], 
+                          color='red', s=20, alpha=0.8, label='High Variance Points',
+                          rasterized=True)
         
         ax2.set_title('Statistical Analysis - REAL Hardware Power Patterns', 
                      fontsize=16, fontweight='bold', pad=15)
@@ -213,9 +455,10 @@ class RealChipWhispererDemo:
         fig.text(0.02, 0.02, 'This is REAL data captured from live ChipWhisperer hardware', 
                 fontsize=12, style='italic', alpha=0.8, color='#2c3e50')
         
-        plt.tight_layout()
-        plt.subplots_adjust(top=0.94, hspace=0.3)
-        plt.savefig(save_path, dpi=300, bbox_inches='tight', facecolor='white')
+        # Fixed layout instead of tight_layout/bbox_inches='tight', which
+        # both re-measure every artist before saving
+        plt.subplots_adjust(left=0.07, right=0.97, bottom=0.08, top=0.90, hspace=0.3)
+        plt.savefig(save_path, dpi=150, facecolor='white')
         plt.close()
         
         print(f"✅ Real hardware plot saved as {save_path}")
@@ -249,7 +492,7 @@ class RealChipWhispererDemo:
             return False
         
         # Generate plot
-        if not self.generate_plot():
+        if not self.generate_plot(analysis):
             print("❌ Demo failed - plot generation failed")
             return False
         
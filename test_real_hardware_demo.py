@@ -0,0 +1,94 @@
+import numpy as np
+import pytest
+
+import real_hardware_demo as demo
+
+
+# NumPy fallback always; the Numba kernel too when Numba is installed
+KERNELS = [pytest.param(demo._accumulate_numpy, id="numpy"),
+           pytest.param(demo._accumulate, id="numba",
+                        marks=pytest.mark.skipif(demo.njit is None,
+                                                 reason="numba not installed"))]
+
+
+def _run(accumulate, traces, splits=()):
+    """Feed traces to accumulate tile by tile, split at the given rows"""
+    m = traces.shape[1]
+    mean, m2, z_sum = np.zeros(m), np.zeros(m), np.zeros(m)
+    bounds = [0, *splits, traces.shape[0]]
+    for lo, hi in zip(bounds, bounds[1:]):
+        accumulate(traces[lo:hi], lo, mean, m2, z_sum)
+    return mean, m2, demo._avg_correlation(z_sum, traces.shape[0])
+
+
+@pytest.mark.parametrize("level", [0, 500, 517, 1023])
+def test_numba_matches_numpy_with_constant_trace(level):
+    pytest.importorskip("numba")
+    rng = np.random.default_rng(level)
+    traces = rng.integers(0, 1024, size=(6, 5000)).astype(np.int16)
+    traces[2] = level
+
+    mean, m2, corr = _run(demo._accumulate, traces)
+    ref_mean, ref_m2, ref_corr = _run(demo._accumulate_numpy, traces)
+
+    np.testing.assert_allclose(mean, ref_mean, rtol=1e-6)
+    np.testing.assert_allclose(m2, ref_m2, rtol=1e-5)
+    # np.corrcoef is undefined (NaN) for a constant trace; so is the average
+    assert np.isnan(corr) and np.isnan(ref_corr)
+
+
+@pytest.mark.parametrize("accumulate", KERNELS)
+def test_accumulate_across_tiles_matches_numpy(accumulate):
+    rng = np.random.default_rng(7)
+    traces = rng.integers(0, 1024, size=(11, 300)).astype(np.int16)
+    # Shared component so the traces are genuinely correlated
+    traces += (200 * np.sin(np.arange(300) / 10)).astype(np.int16)
+
+    # Later tiles continue from count > 0 (Welford offset / Chan merge)
+    mean, m2, corr = _run(accumulate, traces, splits=(3, 7))
+
+    ref = traces.astype(np.float64)
+    corr_matrix = np.corrcoef(ref)
+    np.testing.assert_allclose(mean, ref.mean(axis=0), rtol=1e-9)
+    np.testing.assert_allclose(m2 / len(ref), ref.var(axis=0), rtol=1e-6)
+    assert corr == pytest.approx(corr_matrix[np.triu_indices(len(ref), k=1)].mean(),
+                                 abs=1e-6)
+
+
+class _FakeTarget:
+    def flush(self):
+        pass
+
+
+class _FakeCW:
+    """Stands in for chipwhisperer: capture i fails when i is in `fail`"""
+
+    def __init__(self, nsamples, fail):
+        self.nsamples = nsamples
+        self.fail = fail
+
+    def capture_trace(self, scope, target, plaintext, as_int=False):
+        if plaintext[0] in self.fail:
+            return None
+        result = type("Trace", (), {})()
+        result.wave = np.full(self.nsamples, plaintext[0], dtype=np.uint16)
+        return result
+
+
+@pytest.mark.parametrize("num_traces, fail", [(12, {3, 7}), (5, set(range(5)))])
+def test_store_path_keeps_only_captured_traces(tmp_path, num_traces, fail):
+    nsamples = 40
+    d = demo.RealChipWhispererDemo(verbose=False)
+    d._cw = _FakeCW(nsamples, fail)
+    d.target = _FakeTarget()
+    d.nsamples = nsamples
+    path = tmp_path / "traces.npy"
+
+    d.capture_multiple_traces(num_traces, store_path=str(path))
+
+    kept = [i for i in range(num_traces) if i not in fail]
+    stored = np.load(path)
+    assert d.n_captured == len(kept)
+    assert stored.shape == (len(kept), nsamples)
+    np.testing.assert_array_equal(stored[:, 0], kept)
+    np.testing.assert_array_equal(stored, d.traces)